@@ -1,6 +1,10 @@
 INDEX_FILE = "index.trained"
 TOKEN_ID_FILE = "token_ids.pt"
 INPUT_ID_FILE = "input_ids.pt"
+KEY_MMAP_FILE = "keys.mmap"
+TOKEN_ID_MMAP_FILE = "token_ids.mmap"
+INPUT_ID_MMAP_FILE = "input_ids.mmap"
 RAW_FEATURE_KEY_SUFFIX = ".pt"
 RAW_FEATURE_VALUE_SUFFIX = "_values.pt"
-RAW_FEATURE_TOKEN_SUFFIX = "_tokens.pt"
\ No newline at end of file
+RAW_FEATURE_TOKEN_SUFFIX = "_tokens.pt"
+RAW_FEATURE_SAFETENSORS_SUFFIX = ".safetensors"
\ No newline at end of file
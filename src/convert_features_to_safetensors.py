@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @Filename:    convert_features_to_safetensors.py
+# One-time conversion of raw features saved by get_representations.py with torch.save into safetensors shards.
+
+import argparse
+import os
+
+import torch
+import tqdm
+
+from constants import (
+    RAW_FEATURE_KEY_SUFFIX,
+    RAW_FEATURE_SAFETENSORS_SUFFIX,
+    RAW_FEATURE_TOKEN_SUFFIX,
+    RAW_FEATURE_VALUE_SUFFIX,
+)
+from utils.feature_shards import save_shard
+
+
+def main(args):
+    """Function to convert the .pt feature files of each batch into one .safetensors shard."""
+    with os.scandir(args.feature_dir) as entries:
+        value_files = sorted(
+            entry.name
+            for entry in entries
+            if entry.name.endswith(RAW_FEATURE_VALUE_SUFFIX)
+        )
+    for file_name in tqdm.tqdm(value_files, desc="Converting feature files"):
+        file_id = file_name.split(RAW_FEATURE_VALUE_SUFFIX)[0]
+        paths = [
+            os.path.join(args.feature_dir, file_id + suffix)
+            for suffix in (
+                RAW_FEATURE_KEY_SUFFIX,
+                RAW_FEATURE_VALUE_SUFFIX,
+                RAW_FEATURE_TOKEN_SUFFIX,
+            )
+        ]
+        keys, labels, input_ids = (
+            torch.load(path, map_location="cpu") for path in paths
+        )
+        save_shard(
+            os.path.join(args.feature_dir, file_id + RAW_FEATURE_SAFETENSORS_SUFFIX),
+            keys,
+            labels,
+            input_ids,
+        )
+        if args.remove_pt:
+            for path in paths:
+                os.remove(path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Convert raw feature tensors to safetensors shards"
+    )
+    parser.add_argument(
+        "--feature_dir",
+        type=str,
+        required=True,
+        help="the directory of the generated raw features",
+    )
+    parser.add_argument(
+        "--remove_pt",
+        action="store_true",
+        help="remove the .pt files after conversion",
+    )
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -5,8 +5,12 @@
 
 import argparse
 import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from typing import Tuple
 
 import faiss  # make faiss available
@@ -18,12 +22,26 @@ import tqdm
 from constants import (
     INDEX_FILE,
     INPUT_ID_FILE,
+    INPUT_ID_MMAP_FILE,
+    KEY_MMAP_FILE,
     RAW_FEATURE_KEY_SUFFIX,
+    RAW_FEATURE_SAFETENSORS_SUFFIX,
     RAW_FEATURE_TOKEN_SUFFIX,
     RAW_FEATURE_VALUE_SUFFIX,
     TOKEN_ID_FILE,
+    TOKEN_ID_MMAP_FILE,
 )
+from utils.feature_shards import SHARD_TENSOR_NAMES, load_shard, read_shard_shape
 from utils.get_projection_matrix import transform_and_normalize, whitening
+from utils.kmeans import minibatch_kmeans_gpu
+from utils.knn_scatter_softmax import TRITON_AVAILABLE, knn_scatter_softmax
+
+GPU_TEMP_MEMORY = 2 * 1024**3  # 2GB of FAISS scratch memory per GPU
+GPU_PINNED_MEMORY = 1024**3  # 1GB of pinned host memory for FAISS transfers
+# the numbers of sub-quantizers (bytes per code) supported by GPU IVF-PQ, and the sub-quantizer dimensions it
+# supports without precomputed tables (usePrecomputed = False)
+GPU_PQ_NUM_SUBQUANTIZERS = (1, 2, 3, 4, 8, 12, 16, 20, 24, 28, 32, 40, 48, 56, 64, 96)
+GPU_PQ_SUBQUANTIZER_DIMS = (1, 2, 3, 4, 6, 8, 10, 12, 16, 20, 24, 28, 32)
 
 # set up logger
 logger = logging.getLogger(__name__)
@@ -34,118 +52,484 @@ logging.basicConfig(
 )
 
 
+def _load_mmap(path: str) -> torch.Tensor:
+    """
+    Load a saved tensor on CPU, memory-mapped where possible so that its storage is only read when touched.
+    :param path: path to the saved tensor.
+    :return: the tensor.
+    """
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except (TypeError, RuntimeError):
+        # older torch versions and legacy (non-zipfile) files cannot be memory-mapped
+        return torch.load(path, map_location="cpu")
+
+
+def _read_shape(path: str) -> Tuple:
+    """
+    Read the shape of a saved tensor, without materializing its storage where possible.
+    :param path: path to the saved tensor.
+    :return: the shape of the tensor.
+    """
+    try:
+        tensor = _load_mmap(path)
+    except Exception as e:
+        logger.error(f"Failed to load {path}.")
+        raise IOError(e)
+    shape = tuple(tensor.shape)
+    del tensor
+    return shape
+
+
+def _read_shard_shape(shard: Tuple, name: str) -> Tuple:
+    """
+    Read the shape of the keys, values or tokens of a shard.
+    :param shard: the key, value and input id paths of the shard, or the path of a single safetensors shard.
+    :param name: one of SHARD_TENSOR_NAMES.
+    :return: the shape of the tensor.
+    """
+    if len(shard) == 1:
+        try:
+            return read_shard_shape(shard[0], name)
+        except Exception as e:
+            logger.error(f"Failed to load {shard[0]}.")
+            raise IOError(e)
+    return _read_shape(shard[SHARD_TENSOR_NAMES.index(name)])
+
+
+def _allocate_store(
+    shape: Tuple, dtype: np.dtype, cache_dir: str = None, file_name: str = None
+) -> np.ndarray:
+    """
+    Allocate an uninitialized store, either in memory or as a memory-mapped file.
+    :param shape: shape of the store.
+    :param dtype: numpy dtype of the store.
+    :param cache_dir: if set, the store is memory-mapped to cache_dir/file_name.
+    :param file_name: file name of the memory-mapped store.
+    :return: the allocated store.
+    """
+    if cache_dir is None:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(
+        os.path.join(cache_dir, file_name), dtype=dtype, mode="w+", shape=shape
+    )
+
+
+def _shared_memory_dir(shapes: Tuple, dtypes: Tuple) -> str:
+    """
+    Get the directory for temporary stores shared between worker processes. /dev/shm is only used if it can hold
+    the stores, writing to a memmap beyond the size of the tmpfs (64MB in docker by default) kills the process
+    with a SIGBUS.
+    :param shapes: the shapes of the stores.
+    :param dtypes: the numpy dtypes of the stores.
+    :return: /dev/shm, or None for the default temporary directory.
+    """
+    store_bytes = sum(
+        int(np.prod(shape)) * np.dtype(dtype).itemsize
+        for shape, dtype in zip(shapes, dtypes)
+    )
+    if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free > store_bytes:
+        return "/dev/shm"
+    logger.warning(
+        f"/dev/shm cannot hold the {store_bytes} bytes of the stores, using the temporary directory on disk. "
+        "Set --feature_cache_dir to choose the location."
+    )
+    return None
+
+
+def _copy_shard_to_files(paths: Tuple, offset: int, store_specs: Tuple) -> None:
+    """
+    Load one shard of raw features in a worker process and copy it into the memory-mapped stores.
+    :param paths: the paths of the shard, see DataStore._copy_shard.
+    :param offset: the row of the stores where the shard starts.
+    :param store_specs: the path, dtype and shape of the key, label id and input id stores.
+    :return: None. The stores are updated in place.
+    """
+    stores = tuple(
+        np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+        for path, dtype, shape in store_specs
+    )
+    DataStore._copy_shard(paths, offset, stores)
+
+
+def _gpu_resources() -> faiss.StandardGpuResources:
+    """
+    Create FAISS GPU resources with explicit temporary and pinned memory pools, large enough for adding and
+    searching big inverted lists without reallocating.
+    :return: the GPU resources.
+    """
+    resources = faiss.StandardGpuResources()
+    resources.setTempMemory(GPU_TEMP_MEMORY)
+    resources.setPinnedMemory(GPU_PINNED_MEMORY)
+    return resources
+
+
+def _num_subquantizers(d: int) -> int:
+    """
+    Get the number of PQ sub-quantizers, the largest one supported by GPU IVF-PQ that divides the key dimension
+    into a supported sub-quantizer dimension.
+    :param d: dimension of the keys.
+    :return: the number of sub-quantizers, 96 for 768-dim keys.
+    """
+    for m in reversed(GPU_PQ_NUM_SUBQUANTIZERS):
+        if d % m == 0 and d // m in GPU_PQ_SUBQUANTIZER_DIMS:
+            return m
+    raise ValueError(
+        f"Keys of dimension {d} cannot be split into sub-quantizers supported by GPU IVF-PQ, "
+        "use another --dim_reduction or --index_type ivfflat."
+    )
+
+
 class DataStore:
     """
     This class represents a datastore. It can be trained from raw features, saved and loaded from disk.
     During inference time, it can search given a query and return the normalized score for each token.
     """
 
-    def __init__(self, d=768, args=None):
+    def __init__(self, d=768, args=None, index_type="ivfflat"):
         """
         Set the necessary attributes. The number follow the original paper.
+        :param index_type: "ivfflat" for an IVF index with the same coarse quantizer as the original IndexIVFFlat, but
+        with the lists stored as fp16 scalar-quantized codes of the full keys, or "ivfpq" for an OPQ-rotated IVF-PQ
+        index (96 bytes per key for d=768). The OPQ rotation is applied on the host, so adding and searching with
+        "ivfpq" goes through host memory.
         """
-        co = faiss.GpuClonerOptions()
-        # co.useFloat16 = True  # to avoid GPU memory issue
-        resources = faiss.StandardGpuResources()
+        co = faiss.GpuMultipleClonerOptions()
+        # fp16 coarse quantizer and IVF-PQ lookup tables, the fp16 lists of the ivfflat index come from its
+        # scalar quantizer below
+        co.useFloat16 = True
+        co.useFloat16CoarseQuantizer = True
+        co.usePrecomputed = False  # IVF-PQ only
+        co.indicesOptions = faiss.INDICES_32_BIT
+        co.shard = True  # with multiple GPUs, shard the inverted lists across them
+        self.co = co
+        # one resource object per GPU, reused for training, adding and searching, so that FAISS allocates its
+        # temporary and pinned memory pools only once
+        self.gpu_resources = [
+            _gpu_resources() for _ in range(max(1, torch.cuda.device_count()))
+        ]
         self.d = d  # dimension of keys #1024 is from paper
         n_centroids = 4096  # number of clustering centroids to learn # 4096 was original
 
+        self.n_centroids = n_centroids
+        self.index_type = index_type
+
         metric = faiss.METRIC_L2
         quantizer = faiss.IndexFlatL2(self.d)
-        index = faiss.IndexIVFFlat(quantizer, d, n_centroids, metric)
-        index = faiss.index_cpu_to_gpu(resources, 0, index, co)
-        index.nprobe = 32  # number of clusters to query, 32 was original
+        if index_type == "ivfpq":
+            # 8-bit codes per sub-vector, the distances become approximate but the lookup tables fit in L1
+            m = _num_subquantizers(d)
+            index = faiss.IndexPreTransform(
+                faiss.OPQMatrix(d, m),
+                faiss.IndexIVFPQ(quantizer, d, n_centroids, m, 8, metric),
+            )
+        else:
+            index = self._ivf_fp16_index(quantizer)
+        # the index is trained on a single GPU, and only spread over all GPUs for adding the keys
+        self.index = self._set_nprobe(
+            faiss.index_cpu_to_gpu(self.gpu_resources[0], 0, index, co)
+        )
         self.vocab_size = -1  # to be set later
-        self.index = index
 
+        # samples the training keys, seeded from --seed
+        self.rng = np.random.default_rng(args.seed if args else None)
         if args:
             self.args = args
 
-    def load(self, saved_dir: str) -> None:
+    def _ivf_fp16_index(self, quantizer) -> faiss.Index:
+        """
+        Build an IVF index over the full keys, with the inverted lists stored in fp16. It is cloned to a
+        GpuIndexIVFScalarQuantizer, as GpuIndexIVFFlat can only hold fp32 lists.
+        :param quantizer: the coarse quantizer.
+        :return: the index.
+        """
+        return faiss.IndexIVFScalarQuantizer(
+            quantizer,
+            self.d,
+            self.n_centroids,
+            faiss.ScalarQuantizer.QT_fp16,
+            faiss.METRIC_L2,
+        )
+
+    @staticmethod
+    def _set_nprobe(index, nprobe: int = 32):
+        """
+        Set the number of clusters to query, also for indexes sharded across GPUs.
+        :param index: the FAISS index.
+        :param nprobe: number of clusters to query, 32 was original.
+        :return: the index.
+        """
+        faiss.GpuParameterSpace().set_index_parameter(index, "nprobe", nprobe)
+        return index
+
+    def load(self, saved_dir: str, device: str = None) -> None:
         """
         Load the pretrained FAISS index from a directory with the necessary components. The directory should include:
         - index.trained : the trained index
         - token_ids.pt : the label ids sorted by their index id in FAISS.
         - input_ids.pt : the token ids sorted by their index id in FAISS.
         :param saved_dir: The directory containing the trained index.
+        :param device: The device to search on, defaults to "cuda" if available, else "cpu".
         :return: None. The attributes of this Datastore instance will be set.
         """
         logger.info(
             f"Started loading trained index and token ids lookup from {saved_dir}"
         )
+        device = torch.device(
+            device or ("cuda" if torch.cuda.is_available() else "cpu")
+        )
+        if device.type == "cuda" and device.index is None:
+            # the current device, e.g. the one set by accelerate for the local rank, for both the index and the stores
+            device = torch.device("cuda", torch.cuda.current_device())
         self.index = faiss.read_index(os.path.join(saved_dir, INDEX_FILE))
-        self.label_id_store = torch.tensor(
-            torch.load(os.path.join(saved_dir, TOKEN_ID_FILE))
+        if device.type == "cuda":
+            # search on GPU, so that the neighbors never leave the device in search_k
+            self.index = self._set_nprobe(
+                faiss.index_cpu_to_gpu(
+                    self.gpu_resources[0], device.index, self.index, self.co
+                )
+            )
+        self.label_id_store = self._load_id_store(
+            os.path.join(saved_dir, TOKEN_ID_FILE), device
         )
-        self.input_id_store = torch.tensor(
-            torch.load(os.path.join(saved_dir, INPUT_ID_FILE))
+        self.input_id_store = self._load_id_store(
+            os.path.join(saved_dir, INPUT_ID_FILE), device
         )
         logger.info(f"Finished loading trained index and token ids from {saved_dir}")
 
-    def train_index(self, key_store: np.ndarray) -> None:
+    @staticmethod
+    def _load_id_store(path: str, device: torch.device) -> torch.Tensor:
+        """
+        Load a label or input id store, cached on the search device.
+        :param path: path to the saved store.
+        :param device: the device to cache the store on.
+        :return: the store as an int32 tensor, label and token ids stay far below 2^31.
+        """
+        store = _load_mmap(path).to(dtype=torch.int32)
+        if device.type == "cuda":
+            store = store.pin_memory().to(device, non_blocking=True)
+        return store
+
+    def train_index(self, key_store: np.ndarray, gpu_kmeans: bool = False) -> None:
         """
         Training the FAISS index. We will perform random sampling on the keys.
         :param key_store: a numpy array with shape (num_keys, dim_keys), each row is a key
+        :param gpu_kmeans: learn the centroids with mini-batch k-means on GPU, streaming the keys from key_store.
         :return: None. The index attribute will be updated after training.
         """
         logger.info(f"Start training the index, this might take a long time.")
         start = time.time()
-        self.index.train(key_store)
+        if gpu_kmeans and self.index_type == "ivfflat":
+            self._train_with_gpu_kmeans(key_store)
+        else:
+            if gpu_kmeans:
+                logger.warning(
+                    "GPU mini-batch k-means only supports the ivfflat index, the OPQ rotation of the ivfpq index "
+                    "is learned together with the centroids. Training with FAISS instead."
+                )
+            max_train_keys = 256 * self.n_centroids
+            if len(key_store) > max_train_keys:
+                # k-means only needs a few hundred keys per centroid, all keys are still added afterwards.
+                # Sorting the sample keeps the reads from (memory-mapped) stores sequential.
+                sample = np.sort(
+                    self.rng.choice(len(key_store), max_train_keys, replace=False)
+                )
+                key_store = key_store[sample]
+                logger.info(f"Training on a random sample of {max_train_keys} keys.")
+            # FAISS only trains on fp32 input, the GPU index stores the keys in fp16 itself
+            self.index.train(np.ascontiguousarray(key_store, dtype=np.float32))
         logger.info(
             f"Finished training the index. It took {(time.time() - start)} seconds."
         )
-        self.index = faiss.index_gpu_to_cpu(self.index)  # put back to CPU
+        if len(self.gpu_resources) > 1:
+            # the trained index holds no keys yet, so the round-trip over the CPU only copies the centroids
+            self.index = self._set_nprobe(
+                faiss.index_cpu_to_gpu_multiple_py(
+                    self.gpu_resources, faiss.index_gpu_to_cpu(self.index), co=self.co
+                )
+            )
 
-    def read_feature_files(self, feature_dir: str, percentage: int = 100) -> Tuple:
+    def _train_with_gpu_kmeans(self, key_store: np.ndarray) -> None:
+        """
+        Train the IVF index with centroids from mini-batch k-means on GPU. The centroids are added to the quantizer
+        of a fresh index, so that FAISS only has to train the (trivial) fp16 scalar quantizer.
+        :param key_store: a numpy array with shape (num_keys, dim_keys), each row is a key
+        :return: None. The index attribute will be replaced by the trained index.
         """
-        Read the raw features generated by generate_raw_feature.py, and stack them into on single tensor.
+        centroids = minibatch_kmeans_gpu(key_store, k=self.n_centroids, rng=self.rng)
+        quantizer = faiss.IndexFlatL2(self.d)
+        quantizer.add(centroids.cpu().numpy())
+        index = self._ivf_fp16_index(quantizer)
+        # the quantizer already holds n_centroids vectors and is not retrained, and the fp16 scalar quantizer
+        # needs no training, this only marks the index as trained
+        index.train(centroids.cpu().numpy())
+        assert index.is_trained
+        self.index = self._set_nprobe(
+            faiss.index_cpu_to_gpu(self.gpu_resources[0], 0, index, self.co)
+        )
+
+    def read_feature_files(
+        self,
+        feature_dir: str,
+        percentage: int = 100,
+        cache_dir: str = None,
+        processes: bool = False,
+        key_dtype: np.dtype = np.float32,
+    ) -> Tuple:
+        """
+        Read the raw features generated by get_representations.py, and copy them into preallocated stores. Batches
+        converted to safetensors are read from their safetensors shard instead of their .pt files.
         :param feature_dir: The directory containing the raw features.
         :param percentage: The percentage of files to read from (mainly for testing purpose).
+        :param cache_dir: If set, the stores are memory-mapped files in this directory instead of in-memory arrays.
+        :param processes: Decode the shards in a process pool instead of a thread pool, unpickling .pt files is
+        CPU-bound and holds the GIL.
+        :param key_dtype: numpy dtype of the key store, the keys of each shard are cast while they are copied.
         :return:
         key_store: a numpy array of shape (num_keys, dim_keys), each row is a key
-        label_id_store: a numpy array of shape (num_keys, 1), each row represents the value (target token) to the key.
+        label_id_store: a numpy array of shape (num_keys,), each row represents the value (target token) to the key.
+        input_id_store: a numpy array of shape (num_keys,), each row represents the input token of the key.
         """
-        value_files = list(
-            filter(
-                lambda x: x.endswith(RAW_FEATURE_VALUE_SUFFIX), os.listdir(feature_dir)
-            )
-        )
-        value_files = value_files[: int(len(value_files) * (percentage / 100.0))]
-        key_store = []
-        label_id_store = []
-        input_id_store = []
+        # a single directory scan, the file types come cached with the entries. Sorting keeps the key order, and
+        # with it the ids in the index, deterministic.
+        with os.scandir(feature_dir) as entries:
+            file_names = sorted(entry.name for entry in entries if entry.is_file())
+        # one shard per file id, a safetensors shard replaces the .pt files of the same batch. Directories with a
+        # partial conversion, or new safetensors shards next to older .pt batches, hold both.
+        shards = {}
+        for file_name in file_names:
+            if file_name.endswith(RAW_FEATURE_VALUE_SUFFIX):
+                file_id = file_name.split(RAW_FEATURE_VALUE_SUFFIX)[0]
+                shards.setdefault(
+                    file_id,
+                    tuple(
+                        os.path.join(feature_dir, file_id + suffix)
+                        for suffix in (
+                            RAW_FEATURE_KEY_SUFFIX,
+                            RAW_FEATURE_VALUE_SUFFIX,
+                            RAW_FEATURE_TOKEN_SUFFIX,
+                        )
+                    ),
+                )
+            elif file_name.endswith(RAW_FEATURE_SAFETENSORS_SUFFIX):
+                # each safetensors shard holds the keys, values and tokens of one batch
+                file_id = file_name[: -len(RAW_FEATURE_SAFETENSORS_SUFFIX)]
+                shards[file_id] = (os.path.join(feature_dir, file_name),)
+        shards = [shards[file_id] for file_id in sorted(shards)]
+        shards = shards[: int(len(shards) * (percentage / 100.0))]
+        if not shards:
+            raise IOError(f"No feature files found in {feature_dir}")
         start_time = time.time()
-        for file_name in tqdm.tqdm(
-            value_files, total=len(value_files), desc="Loading feature files"
+
+        # first pass: only read the shapes, so that the stores can be allocated up-front. The values are
+        # one-dimensional and hold one entry per key, the key dimension is read from a single shard.
+        offsets = []
+        total_keys = 0
+        for shard in tqdm.tqdm(
+            shards, total=len(shards), desc="Reading feature shapes"
         ):
-            file_id = file_name.split(RAW_FEATURE_VALUE_SUFFIX)[0]
-            key_path = os.path.join(feature_dir, str(file_id) + RAW_FEATURE_KEY_SUFFIX)
-            value_path = os.path.join(
-                feature_dir, str(file_id) + RAW_FEATURE_VALUE_SUFFIX
+            offsets.append(total_keys)
+            total_keys += _read_shard_shape(shard, "values")[0]
+        key_dim = _read_shard_shape(shards[0], "keys")[1]
+
+        store_files = (KEY_MMAP_FILE, TOKEN_ID_MMAP_FILE, INPUT_ID_MMAP_FILE)
+        store_shapes = ((total_keys, key_dim), (total_keys,), (total_keys,))
+        # label and input ids stay far below 2^31, int32 halves their memory and the size of the saved stores
+        store_dtypes = (key_dtype, np.int32, np.int32)
+
+        # worker processes write straight into file-backed stores, which are shared through the page cache, instead of
+        # pickling the decoded shards back through a pipe. Without a cache_dir these live in a temporary directory.
+        store_dir = cache_dir
+        if processes and store_dir is None:
+            store_dir = tempfile.mkdtemp(
+                dir=_shared_memory_dir(store_shapes, store_dtypes)
             )
-            input_id_path = os.path.join(
-                feature_dir, str(file_id) + RAW_FEATURE_TOKEN_SUFFIX
+        try:
+            stores = tuple(
+                _allocate_store(shape, dtype, store_dir, file_name)
+                for shape, dtype, file_name in zip(
+                    store_shapes, store_dtypes, store_files
+                )
             )
-            try:
-                curr_keys = torch.load(key_path)
-                curr_label_ids = torch.load(value_path)
-                curr_input_ids = torch.load(input_id_path)
-            except Exception as e:
-                logger.error(f"Failed to load {key_path} or {value_path}.")
-                raise IOError(e)
-            key_store += (
-                curr_keys.cpu()
-            )  # ensure that it is on CPU, as numpy doesn't support GPU
-            label_id_store += curr_label_ids.cpu()
-            input_id_store += curr_input_ids.cpu()
-        key_store = np.stack(key_store)
-        label_id_store = np.stack(label_id_store)
-        input_id_store = np.stack(input_id_store)
+            key_store = stores[0]
+
+            # second pass: decode the shards concurrently, each worker writes into its own slice of the stores
+            if processes:
+                # spawned, as forking a process that already holds a CUDA context, FAISS GPU resources and
+                # OpenMP threads can deadlock the workers on locks held at the time of the fork
+                executor = ProcessPoolExecutor(
+                    max_workers=min(8, os.cpu_count() or 1),
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                store_specs = tuple(
+                    (os.path.join(store_dir, file_name), dtype, shape)
+                    for shape, dtype, file_name in zip(
+                        store_shapes, store_dtypes, store_files
+                    )
+                )
+                futures = [
+                    executor.submit(_copy_shard_to_files, paths, offset, store_specs)
+                    for paths, offset in zip(shards, offsets)
+                ]
+            else:
+                executor = ThreadPoolExecutor(max_workers=min(16, os.cpu_count() or 1))
+                futures = [
+                    executor.submit(self._copy_shard, paths, offset, stores)
+                    for paths, offset in zip(shards, offsets)
+                ]
+            with executor:
+                try:
+                    for future in tqdm.tqdm(
+                        as_completed(futures),
+                        total=len(futures),
+                        desc="Loading feature files",
+                    ):
+                        future.result()
+                except Exception:
+                    # don't decode the remaining shards after a failure
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            if store_dir != cache_dir:
+                # the stores stay mapped after their files are removed, and don't leak if loading failed
+                shutil.rmtree(store_dir)
 
         logger.info(
             f"{len(key_store)} keys and values, used {time.time() - start_time} seconds"
         )
-        return key_store, label_id_store, input_id_store
+        # plain ndarray views in case of memmaps, faiss.contrib.torch_utils only dispatches exact np.ndarray to numpy
+        return tuple(np.asarray(store) for store in stores)
+
+    @staticmethod
+    def _copy_shard(paths: Tuple, offset: int, stores: Tuple) -> None:
+        """
+        Load one shard of raw features and copy it into the stores.
+        :param paths: the key, value and input id paths of the shard, or the path of a single safetensors shard.
+        :param offset: the row of the stores where the shard starts.
+        :param stores: the key, label id and input id stores to write into.
+        :return: None. The stores are updated in place.
+        """
+        key_store, label_id_store, input_id_store = stores
+        try:
+            if len(paths) == 1:
+                shard = load_shard(paths[0])
+                curr_keys, curr_label_ids, curr_input_ids = (
+                    shard[name] for name in SHARD_TENSOR_NAMES
+                )
+            else:
+                # ensure that it is on CPU, as numpy doesn't support GPU
+                curr_keys, curr_label_ids, curr_input_ids = (
+                    torch.load(path, map_location="cpu").numpy() for path in paths
+                )
+        except Exception as e:
+            logger.error(f"Failed to load {paths}.")
+            raise IOError(e)
+        # a single memcpy per shard, instead of iterating the tensors row by row
+        n = curr_keys.shape[0]
+        np.copyto(key_store[offset : offset + n], curr_keys)
+        np.copyto(label_id_store[offset : offset + n], curr_label_ids)
+        np.copyto(input_id_store[offset : offset + n], curr_input_ids)
 
     def read_features_and_train(
         self, feature_dir: str, output_dir: str, percentage: int = 100
@@ -158,10 +542,19 @@ class DataStore:
         :return: None. The trained index will be saved to output_dir.
         """
         key_store, label_id_store, input_id_store = self.read_feature_files(
-            feature_dir=feature_dir, percentage=percentage
+            feature_dir=feature_dir,
+            percentage=percentage,
+            cache_dir=self.args.feature_cache_dir,
+            processes=self.args.load_with_processes,
+            # the keys are whitened in fp32, and only written in fp16 by the projection
+            key_dtype=(
+                np.float16
+                if self.args.fp16_keys and not self.args.whitening
+                else np.float32
+            ),
         )
-        self.label_id_store = torch.tensor(label_id_store)
-        self.input_id_store = torch.tensor(input_id_store)
+        self.label_id_store = torch.as_tensor(label_id_store, dtype=torch.int32)
+        self.input_id_store = torch.as_tensor(input_id_store, dtype=torch.int32)
 
         if self.args.whitening:
             logger.info("****** Getting Projection ******")
@@ -174,45 +567,122 @@ class DataStore:
             torch.save(kernel, f"{output_dir}/kernel.pt")
             torch.save(bias, f"{output_dir}/bias.pt")
 
-            key_store = transform_and_normalize(key_store, kernel, bias)
+            # with fp16_keys, the host memory of the keys is halved, they are cast back to fp32 chunk-wise when
+            # handed to FAISS
+            key_store = transform_and_normalize(
+                key_store,
+                kernel,
+                bias,
+                out_dtype=np.float16 if self.args.fp16_keys else np.float32,
+            )
             # print(key_store.size())
 
-        self.train_index(key_store)
+        self.train_index(key_store, gpu_kmeans=self.args.gpu_kmeans)
         self.add_keys(key_store)
         self.save(output_dir)
         return
 
-    def add_keys(self, keys_to_add: np.ndarray) -> None:
+    def add_keys(self, keys_to_add: np.ndarray, chunk_size: int = 1 << 18) -> None:
         """
-        Add the keys to the trained index.
+        Add the keys to the trained index. The keys are streamed in chunks through pinned staging buffers, a
+        background thread stages and uploads the next chunk while the index adds the current one.
         :param keys_to_add: a numpy array of shape (num_keys, keys_dim)
+        :param chunk_size: the number of keys per chunk, 1 << 18 keeps a 768-dim staging buffer at 768MB.
         :return: The index will be updated with the input keys.
         """
         logger.info("Start adding keys to the index.")
         start_time = time.time()
-        self.index.add(keys_to_add)  # add vectors to the index
+        # the index is always built on GPU in __init__, the staging buffers also cast fp16 keys to fp32 for FAISS
+        self._add_keys_pipelined(keys_to_add, chunk_size)
         logger.info(
             f"Finished adding keys to the index. It took {time.time() - start_time} seconds"
         )
 
+    def _add_keys_pipelined(self, keys_to_add: np.ndarray, chunk_size: int) -> None:
+        """
+        Add the keys to the GPU index chunk by chunk, double buffering the chunks in pinned memory. index.add blocks
+        until the list assignments are back on the host, but releases the GIL, so a single background thread fills
+        (and uploads) the other buffer in the meantime.
+        :param keys_to_add: a numpy array of shape (num_keys, keys_dim)
+        :param chunk_size: the number of keys per chunk.
+        :return: The index will be updated with the input keys.
+        """
+        num_keys = len(keys_to_add)
+        chunk_size = min(chunk_size, num_keys)
+        staging = [
+            torch.empty(
+                (chunk_size, keys_to_add.shape[1]), dtype=torch.float32, pin_memory=True
+            )
+            for _ in range(2)
+        ]
+        # indexes sharded over several GPUs only take host memory, and copy it to the devices themselves
+        device = (
+            torch.device("cuda", self.index.getDevice())
+            if hasattr(self.index, "getDevice")
+            else None
+        )
+        copy_stream = torch.cuda.Stream(device) if device is not None else None
+
+        def stage(step: int, offset: int) -> torch.Tensor:
+            buffer = staging[step % 2][: min(chunk_size, num_keys - offset)]
+            buffer.copy_(torch.as_tensor(keys_to_add[offset : offset + len(buffer)]))
+            if device is None:
+                return buffer
+            with torch.cuda.stream(copy_stream):
+                keys = buffer.to(device, non_blocking=True)
+            # the buffer can be refilled once this returns
+            copy_stream.synchronize()
+            return keys
+
+        offsets = range(0, num_keys, chunk_size)
+        with ThreadPoolExecutor(max_workers=1) as stager:
+            pending = stager.submit(stage, 0, 0)
+            for step, offset in enumerate(tqdm.tqdm(offsets, desc="Adding keys")):
+                keys = pending.result()
+                if step + 1 < len(offsets):
+                    # the other buffer was released by the add of the previous chunk, which has returned
+                    pending = stager.submit(stage, step + 1, offsets[step + 1])
+                if device is not None:
+                    # allocated on the copy stream, but added on the current one
+                    keys.record_stream(torch.cuda.current_stream(device))
+                self.index.add(keys)
+                del keys
+
     def save(self, output_dir: str) -> None:
         """
         Save the index and the index-to-token mapping in the output_dir.
         :param output_dir: The directory to save the results.
         :return: None. Results will be saved to output_dir.
         """
+        # the three writes are independent, and FAISS releases the GIL while writing, so the index overlaps with
+        # pickling the id stores
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            # write the trained index, the index stays on GPU until here
+            index_future = executor.submit(
+                lambda: faiss.write_index(
+                    faiss.index_gpu_to_cpu(self.index),
+                    os.path.join(output_dir, INDEX_FILE),
+                )
+            )
+            store_futures = [
+                executor.submit(torch.save, store, path, pickle_protocol=5)
+                for store, path in (
+                    # save the index for token_ids
+                    (self.label_id_store, os.path.join(output_dir, TOKEN_ID_FILE)),
+                    # save the index for input_ids
+                    (self.input_id_store, os.path.join(output_dir, INPUT_ID_FILE)),
+                )
+            ]
+
         try:
-            # write the trained index
-            faiss.write_index(self.index, os.path.join(output_dir, INDEX_FILE))
+            index_future.result()
         except Exception as e:
             logger.error(f"Encountered error when writing FAISS index to {output_dir}")
             raise IOError(e)
 
         try:
-            # save the index for token_ids
-            torch.save(self.label_id_store, os.path.join(output_dir, TOKEN_ID_FILE))
-            # save the index for input_ids
-            torch.save(self.input_id_store, os.path.join(output_dir, INPUT_ID_FILE))
+            for future in store_futures:
+                future.result()
         except Exception as e:
             logger.error(f"Encountered error when saving torch tensor to {output_dir}")
             raise IOError(e)
@@ -234,25 +704,40 @@ class DataStore:
         Search for the top K nearest neighbors, along with the distance.
         :param T: temperature
         :param k: top k
-        :param query: should have shape (num_queries, dim_keys).
+        :param query: a torch tensor (numpy arrays are converted once), should have shape (num_queries, dim_keys).
         :return: scores: should have shape (num_queries, vocab_size), contains scores for each token for each entry
         """
         assert (
             self.vocab_size >= 1
         ), "Please set the vocab size first (using set_vocab_size method) before the search!"
+        # with a torch query, faiss.contrib.torch_utils returns torch tensors, no torch.tensor(D) / (I) copies needed
+        query = torch.as_tensor(query)
         # faiss.normalize_L2(query)
+        if query.is_cuda:
+            if hasattr(self.index, "getDevice"):
+                # FAISS reads the query pointer on the device of the index
+                query = query.to(torch.device("cuda", self.index.getDevice()))
+            else:
+                # e.g. the OPQ rotation in front of a GPU IVF-PQ index is applied on the host
+                query = query.cpu()
         D, I = self.index.search(
             query, k
         )  # D, I will have shape (num_queries, k), containing the distance and the index
-        actual_label_ids = self.label_id_store[torch.tensor(I)]  # (num_queries, k)
-        actual_input_ids = self.input_id_store[torch.tensor(I)]  # (num_queries, k)
-        scores = torch.zeros((query.shape[0], self.vocab_size))
-        distance_scores = torch.softmax(
-            -torch.tensor(D) / T, dim=-1
-        )  # softmax of the distance
-        scores = scores.scatter(
-            1, actual_label_ids, distance_scores, reduce="add"
-        )  # will assign the scores to indices and aggregate for each token
+        if I.device != self.label_id_store.device:
+            # only for indexes searched on the host, the stores are cached on the search device in load()
+            D = D.to(self.label_id_store.device, non_blocking=True)
+            I = I.to(self.label_id_store.device, non_blocking=True)
+        actual_label_ids = self.label_id_store[I]  # (num_queries, k)
+        actual_input_ids = self.input_id_store[I]  # (num_queries, k)
+        if D.is_cuda and TRITON_AVAILABLE:
+            # softmax and scatter in one kernel, without a (num_queries, k) temporary
+            scores = knn_scatter_softmax(D, actual_label_ids, self.vocab_size, T)
+        else:
+            scores = torch.zeros((query.shape[0], self.vocab_size), device=D.device)
+            distance_scores = torch.softmax(-D / T, dim=-1)  # softmax of the distance
+            scores.scatter_add_(
+                1, actual_label_ids.long(), distance_scores
+            )  # will assign the scores to indices and aggregate for each token
         return scores, actual_input_ids, I
 
 
@@ -284,6 +769,35 @@ def parse_args():
         default=None,  # by default, use all available data
         help="Set a seed for reproducibility",
     )
+    parser.add_argument(
+        "--feature_cache_dir",
+        type=str,
+        default=None,
+        help="memory-map the keys and values read from the features into this directory, instead of holding them in RAM",
+    )
+    parser.add_argument(
+        "--load_with_processes",
+        action="store_true",
+        help="decode the feature files in a process pool, faster for pickled .pt files on many cores",
+    )
+    parser.add_argument(
+        "--fp16_keys",
+        action="store_true",
+        help="hold the keys in fp16 on the host before adding them to the index",
+    )
+    parser.add_argument(
+        "--index_type",
+        type=str,
+        default="ivfflat",
+        choices=["ivfflat", "ivfpq"],
+        help="an IVF index storing the full keys as fp16 scalar-quantized codes (not the fp32 IndexIVFFlat of the "
+        "original setup), or an OPQ + IVF-PQ index with compressed keys (searched through host memory)",
+    )
+    parser.add_argument(
+        "--gpu_kmeans",
+        action="store_true",
+        help="learn the ivfflat centroids with mini-batch k-means on GPU, streaming the keys from host memory",
+    )
     parser.add_argument(
         "--whitening",
         action="store_true",
@@ -312,7 +826,7 @@ def read_and_train():
 
     args = parse_args()
     np.random.seed(args.seed)
-    datastore = DataStore(d=args.dim_reduction, args=args)
+    datastore = DataStore(d=args.dim_reduction, args=args, index_type=args.index_type)
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
@@ -48,9 +48,11 @@ from transformers.utils.versions import require_version
 
 from constants import (
     RAW_FEATURE_KEY_SUFFIX,
+    RAW_FEATURE_SAFETENSORS_SUFFIX,
     RAW_FEATURE_TOKEN_SUFFIX,
     RAW_FEATURE_VALUE_SUFFIX,
 )
+from utils.feature_shards import save_shard
 
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
 check_min_version("4.26.1")
@@ -100,6 +102,13 @@ def parse_args():
         type=str,
         help="directory name to save the generated features, e.g. saved_gen",
     )
+    parser.add_argument(
+        "--save_format",
+        type=str,
+        default="pt",
+        choices=["pt", "safetensors"],
+        help="save the features of each batch as three .pt files, or as a single .safetensors shard",
+    )
     parser.add_argument(
         "--text_column_name",
         type=str,
@@ -562,36 +571,31 @@ def main():
 
             try:
                 dataset_suffix = args.train_file.split("/")[-2]
-                key_path = os.path.join(
-                    args.save_path,
-                    args.label_column_name
-                    + "_"
-                    + dataset_suffix
-                    + "_"
-                    + str(step)
-                    + RAW_FEATURE_KEY_SUFFIX,
+                file_id = (
+                    args.label_column_name + "_" + dataset_suffix + "_" + str(step)
                 )
-                value_path = os.path.join(
-                    args.save_path,
-                    args.label_column_name
-                    + "_"
-                    + dataset_suffix
-                    + "_"
-                    + str(step)
-                    + RAW_FEATURE_VALUE_SUFFIX,
-                )
-                token_path = os.path.join(
-                    args.save_path,
-                    args.label_column_name
-                    + "_"
-                    + dataset_suffix
-                    + "_"
-                    + str(step)
-                    + RAW_FEATURE_TOKEN_SUFFIX,
-                )
-                torch.save(keys, key_path)
-                torch.save(labels, value_path)
-                torch.save(input_ids, token_path)
+                if args.save_format == "safetensors":
+                    save_shard(
+                        os.path.join(
+                            args.save_path, file_id + RAW_FEATURE_SAFETENSORS_SUFFIX
+                        ),
+                        keys,
+                        labels,
+                        input_ids,
+                    )
+                else:
+                    key_path = os.path.join(
+                        args.save_path, file_id + RAW_FEATURE_KEY_SUFFIX
+                    )
+                    value_path = os.path.join(
+                        args.save_path, file_id + RAW_FEATURE_VALUE_SUFFIX
+                    )
+                    token_path = os.path.join(
+                        args.save_path, file_id + RAW_FEATURE_TOKEN_SUFFIX
+                    )
+                    torch.save(keys, key_path)
+                    torch.save(labels, value_path)
+                    torch.save(input_ids, token_path)
             except Exception as e:
                 logger.error(f"Fail to save to {args.save_path}.")
                 raise IOError(e)
@@ -276,6 +276,13 @@ def parse_args():
     parser.add_argument(
         "--datastore_path", type=str, default=None, help="Path to the datastore."
     )
+    parser.add_argument(
+        "--datastore_device",
+        type=str,
+        default=None,
+        help="Device to search the datastore on, e.g. cpu or cuda:1. Defaults to the current GPU if available. "
+        "Use cpu for datastores that do not fit next to the model.",
+    )
     parser.add_argument(
         "--k",
         type=int,
@@ -691,7 +698,7 @@ def main():
     if args.knn:
         # Get datastore
         datastore = DataStore(d=768)
-        datastore.load(args.datastore_path)
+        datastore.load(args.datastore_path, device=args.datastore_device)
         datastore.set_vocab_size(num_labels)
 
     if args.projection:
@@ -718,21 +725,23 @@ def main():
 
             predictions = predictions.flatten(0, 1)
             knn_scores, input_ids, knn_ids = datastore.search_k(
-                query=query.cpu().numpy(), k=args.k, T=float(args.temperature)
+                query=query.contiguous(), k=args.k, T=float(args.temperature)
             )
+            # the scores are on the datastore device, see --datastore_device
+            knn_scores = knn_scores.to(predictions.device)
 
             if args.analysis:
                 labels = batch["labels"]
                 mask = (labels > -100) & (labels < 2)
 
                 predictions_final = (float(args.lambda_value) * knn_scores) + (
-                    (1 - float(args.lambda_value)) * predictions.cpu()
+                    (1 - float(args.lambda_value)) * predictions
                 )
 
                 mask_flat = mask.flatten()
                 for i, batch_token_id in enumerate(batch["input_ids"][mask]):
                     current_k = input_ids[mask_flat][i]
-                    current_i = knn_ids[mask_flat.cpu().numpy()][i]
+                    current_i = knn_ids[mask_flat][i]
 
                     current_batch_word = tokenizer.decode(
                         batch_token_id, clean_up_tokenization_spaces=True
@@ -752,7 +761,7 @@ def main():
 
             # lambda * p_knn + (1-lambda) * p_lm
             predictions = (float(args.lambda_value) * knn_scores) + (
-                (1 - float(args.lambda_value)) * predictions.cpu()
+                (1 - float(args.lambda_value)) * predictions
             )
             predictions = predictions.argmax(dim=-1).view(bsz, sl).cuda()
 
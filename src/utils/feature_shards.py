@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @Filename:    feature_shards.py
+# Reading and writing raw feature shards in the safetensors format. A shard holds the keys, values (label ids)
+# and tokens (input ids) of one batch, so no pickle is involved when building the datastore.
+
+from typing import Dict, Tuple
+
+import numpy as np
+import torch
+from safetensors import safe_open
+from safetensors.numpy import load_file
+from safetensors.torch import save_file
+
+SHARD_TENSOR_NAMES = ("keys", "values", "tokens")
+
+
+def save_shard(
+    path: str, keys: torch.Tensor, labels: torch.Tensor, input_ids: torch.Tensor
+) -> None:
+    """
+    Save the raw features of one batch into a single safetensors file.
+    :param path: path of the shard.
+    :param keys: the hidden states, shape (num_keys, dim_keys).
+    :param labels: the label ids, shape (num_keys,).
+    :param input_ids: the input ids, shape (num_keys,).
+    :return: None. The shard is written to path.
+    """
+    tensors = (keys, labels, input_ids)
+    save_file(
+        {
+            name: tensor.detach().cpu().contiguous()
+            for name, tensor in zip(SHARD_TENSOR_NAMES, tensors)
+        },
+        path,
+    )
+
+
+def load_shard(path: str) -> Dict[str, np.ndarray]:
+    """
+    Load a shard as numpy arrays, without unpickling.
+    :param path: path of the shard.
+    :return: a dict with the keys, values and tokens of the shard.
+    """
+    return load_file(path)
+
+
+def read_shard_shape(path: str, name: str) -> Tuple:
+    """
+    Read the shape of one tensor of a shard from the safetensors header only.
+    :param path: path of the shard.
+    :param name: one of SHARD_TENSOR_NAMES.
+    :return: the shape of the tensor.
+    """
+    with safe_open(path, framework="np") as f:
+        return tuple(f.get_slice(name).get_shape())
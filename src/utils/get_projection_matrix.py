@@ -5,21 +5,58 @@
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 
 def whitening(embs):
     embs = torch.from_numpy(embs)
     mu = torch.mean(embs, dim=0, keepdim=True)
     cov = torch.cov(embs.T)
-    U, s, V = torch.linalg.svd(cov)
-    W = torch.mm(U, torch.diag(1 / torch.sqrt(s)))
+    # the covariance is symmetric, eigh is cheaper than an SVD of it. Flipped to descending eigenvalues, so that
+    # --dim_reduction keeps the leading directions, and scaled by broadcasting instead of a matmul with a diagonal.
+    # Rank-deficient covariances can come out with tiny negative eigenvalues, clamped to keep rsqrt finite.
+    s, V = torch.linalg.eigh(cov)
+    s = s.clamp_min(torch.finfo(s.dtype).tiny)
+    W = V.flip(1) * s.flip(0).rsqrt()
     return W, -mu
 
 
-def transform_and_normalize(embs, kernel, bias):
-    embs = torch.from_numpy(embs) if isinstance(embs, np.ndarray) else embs
+def transform_and_normalize(
+    embs, kernel, bias, chunk_size=1 << 20, out_dtype=np.float32
+):
+    if isinstance(embs, np.ndarray) and torch.cuda.is_available():
+        return _transform_and_normalize_on_gpu(
+            embs, kernel, bias, chunk_size, out_dtype
+        )
+    is_numpy = isinstance(embs, np.ndarray)
+    embs = torch.from_numpy(embs) if is_numpy else embs
     if not (kernel is None or bias is None):
         embs = torch.mm(embs + bias, kernel)
     normalized_embs = embs / torch.norm(embs, dim=1, keepdim=True)
 
+    # numpy in, numpy out, the same as on the GPU
+    if is_numpy:
+        return normalized_embs.numpy().astype(out_dtype, copy=False)
     return normalized_embs
+
+
+def _transform_and_normalize_on_gpu(embs, kernel, bias, chunk_size, out_dtype):
+    # fp32 projection on the GPU, the same precision as the queries in run_inference.py, as whitening scales the
+    # low-variance directions up and would amplify any rounding of the keys. A chunk of rows at a time to bound the
+    # GPU memory. The output is written in out_dtype directly, without an fp32 copy of the keys.
+    project = not (kernel is None or bias is None)
+    out = np.empty(
+        (len(embs), kernel.shape[1] if project else embs.shape[1]), dtype=out_dtype
+    )
+    if project:
+        kernel = torch.as_tensor(kernel).to("cuda", dtype=torch.float32)
+        bias = torch.as_tensor(bias).to("cuda", dtype=torch.float32)
+    for offset in range(0, len(embs), chunk_size):
+        chunk = torch.from_numpy(embs[offset : offset + chunk_size])
+        chunk = chunk.pin_memory().to("cuda", non_blocking=True).float()
+        if project:
+            chunk = torch.mm(chunk + bias, kernel)
+        chunk = F.normalize(chunk, dim=1)
+        out[offset : offset + len(chunk)] = chunk.cpu().numpy()
+
+    return out
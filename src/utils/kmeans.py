@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @Filename:    kmeans.py
+# Mini-batch k-means (Sculley, 2010) on GPU. Only the centroids and one mini-batch live on the device, the keys
+# are streamed from host memory (or a memmap), so the training set never has to be gathered or copied in full.
+
+import numpy as np
+import torch
+import tqdm
+
+
+def _to_device(keys: np.ndarray, device: str) -> torch.Tensor:
+    keys = torch.from_numpy(np.ascontiguousarray(keys, dtype=np.float32))
+    return keys.pin_memory().to(device, non_blocking=True)
+
+
+def _assign(batch: torch.Tensor, centroids: torch.Tensor, chunk_size: int):
+    # chunked, so the (chunk_size, k) distance matrix stays small
+    return torch.cat(
+        [
+            torch.cdist(chunk, centroids).argmin(dim=1)
+            for chunk in batch.split(chunk_size)
+        ]
+    )
+
+
+def minibatch_kmeans_gpu(
+    keys: np.ndarray,
+    k: int = 4096,
+    batch_size: int = 65536,
+    iters: int = 25,
+    chunk_size: int = 8192,
+    device: str = "cuda",
+    rng: np.random.Generator = None,
+) -> torch.Tensor:
+    """
+    Learn k centroids with mini-batch k-means, each centroid moves towards the mean of its assigned keys with a
+    per-centroid learning rate of 1 / (number of keys assigned so far).
+    :param keys: a numpy array (or memmap) of shape (num_keys, dim_keys).
+    :param k: number of centroids.
+    :param batch_size: number of keys sampled per iteration.
+    :param iters: number of iterations.
+    :param chunk_size: number of keys per distance computation.
+    :param device: the device to train on.
+    :param rng: the random generator to sample the keys with, a fresh unseeded one if None.
+    :return: the centroids, a tensor of shape (k, dim_keys) on device.
+    """
+    num_keys = len(keys)
+    rng = rng if rng is not None else np.random.default_rng()
+    # Generator.choice draws without replacement in O(k), unlike np.random.choice it never permutes all keys
+    init = np.sort(rng.choice(num_keys, k, replace=False))
+    centroids = _to_device(keys[init], device)
+    counts = torch.zeros(k, device=device)
+    for _ in tqdm.tqdm(range(iters), desc="Mini-batch k-means"):
+        # sorted, so the reads from a memmap stay sequential
+        sample = np.sort(rng.integers(0, num_keys, size=min(batch_size, num_keys)))
+        batch = _to_device(keys[sample], device)
+        assignment = _assign(batch, centroids, chunk_size)
+        batch_counts = torch.bincount(assignment, minlength=k).float()
+        batch_sums = torch.zeros_like(centroids).index_add_(0, assignment, batch)
+        counts += batch_counts
+        updated = batch_counts > 0
+        centroids[updated] += (
+            batch_sums[updated] - batch_counts[updated, None] * centroids[updated]
+        ) / counts[updated, None]
+    return centroids
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# @Filename:    knn_scatter_softmax.py
+# Fused softmax over the kNN distances and scatter-add of the neighbor weights into the label scores. The
+# softmax stays in registers, instead of writing and re-reading a (num_queries, k) temporary.
+
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:  # triton only ships with the CUDA builds of torch>=2.0
+    triton = None
+
+TRITON_AVAILABLE = triton is not None
+
+if TRITON_AVAILABLE:
+
+    @triton.jit
+    def knn_scatter_softmax_kernel(
+        distances_ptr,
+        labels_ptr,
+        scores_ptr,
+        k,
+        vocab_size,
+        inv_temperature,
+        BLOCK_K: tl.constexpr,
+    ):
+        # one program per query row
+        row = tl.program_id(0).to(tl.int64)
+        offsets = tl.arange(0, BLOCK_K)
+        mask = offsets < k
+        distances = tl.load(distances_ptr + row * k + offsets, mask=mask, other=0.0)
+        logits = tl.where(mask, -distances * inv_temperature, float("-inf"))
+        numerator = tl.exp(logits - tl.max(logits, axis=0))
+        weights = numerator / tl.sum(numerator, axis=0)
+        labels = tl.load(labels_ptr + row * k + offsets, mask=mask, other=0)
+        tl.atomic_add(scores_ptr + row * vocab_size + labels, weights, mask=mask)
+
+
+def knn_scatter_softmax(
+    distances: torch.Tensor, labels: torch.Tensor, vocab_size: int, T: float
+) -> torch.Tensor:
+    """
+    Compute softmax(-distances / T) per query and aggregate the weights per label, in a single kernel.
+    :param distances: CUDA tensor of shape (num_queries, k), the distances to the neighbors.
+    :param labels: CUDA tensor of shape (num_queries, k), the label ids of the neighbors.
+    :param vocab_size: the size of the label space.
+    :param T: temperature
+    :return: scores: shape (num_queries, vocab_size), contains scores for each token for each entry
+    """
+    num_queries, k = distances.shape
+    scores = torch.zeros(
+        (num_queries, vocab_size), device=distances.device, dtype=torch.float32
+    )
+    knn_scatter_softmax_kernel[(num_queries,)](
+        distances.float().contiguous(),
+        labels.contiguous(),
+        scores,
+        k,
+        vocab_size,
+        1.0 / T,
+        BLOCK_K=triton.next_power_of_2(k),
+    )
+    return scores